@@ -1,39 +1,136 @@
 import os
-import stripe
+import time
+import hmac
+import hashlib
+import asyncio
+import queue
+from contextlib import contextmanager, asynccontextmanager
+import orjson
+import anyio
 import secrets
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from passlib.context import CryptContext
 from dotenv import load_dotenv
 
 # --- 数据库驱动 ---
 # 根据环境自动切换 SQLite 或 PostgreSQL
 try:
-    import psycopg2
-    from psycopg2.extras import RealDictCursor
+    import asyncpg
 except ImportError:
-    psycopg2 = None
+    asyncpg = None
 
 import sqlite3
 
 load_dotenv()
 
 # --- 配置 ---
-STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "")
-if STRIPE_SECRET_KEY: stripe.api_key = STRIPE_SECRET_KEY
-
 ADMIN_PASS_RAW = os.getenv("ADMIN_PASSWORD", "admin888")
 SECRET_TOKEN = os.getenv("SECRET_TOKEN", "default-secret-token")
 DATABASE_URL = os.getenv("DATABASE_URL") # Render 会自动注入这个变量
+DB_NAME = "medical.db"
+# 管理员密码 bcrypt 哈希的共享缓存文件（同一台机器上的 worker / reload 共用）
+ADMIN_PASS_HASH_FILE = os.getenv("ADMIN_PASS_HASH_FILE", ".admin_pass_hash")
+# 支持的城市（和前台筛选、后台表单里的选项保持一致），"All" 表示不筛选
+ALLOWED_CITIES = frozenset({"All", "Beijing", "Shanghai", "Guangzhou"})
+# PostgreSQL 连接池大小（Render 免费版数据库连接数有限，可按需调整）
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "20"))
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # 密码截断保护
 if len(ADMIN_PASS_RAW) > 70: ADMIN_PASS_RAW = ADMIN_PASS_RAW[:70]
-ADMIN_PASS_HASH = pwd_context.hash(ADMIN_PASS_RAW)
 
-app = FastAPI()
+# bcrypt 校验是 CPU 密集操作，放到独立线程池里跑，并限制排队长度
+BCRYPT_WORKERS = (os.cpu_count() or 1) * 2
+BCRYPT_MAX_QUEUE = int(os.getenv("BCRYPT_MAX_QUEUE", "32"))
+metrics = {"bcrypt_queue_length": 0}
+
+class ORJSONResponse(JSONResponse):
+    """用 orjson 序列化（比标准库 json 快，原生支持 datetime）"""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+def _warm_bcrypt():
+    """passlib 在第一次 hash/verify 时才加载 bcrypt 后端（约几十 ms），启动时提前加载并确认用的是 C 扩展"""
+    backend = pwd_context.handler("bcrypt").get_backend()
+    if backend != "bcrypt":
+        raise RuntimeError(f"passlib is using the '{backend}' bcrypt backend, install the bcrypt package (see requirements.txt)")
+
+def _admin_pass_fingerprint() -> str:
+    # 用单独的 key，和 admin token 的签名（_sign）互不相通
+    key = ("admin-pass-hash:" + SECRET_TOKEN).encode()
+    return hmac.new(key, ADMIN_PASS_RAW.encode(), hashlib.sha256).hexdigest()
+
+def _read_cached_admin_hash():
+    """缓存格式 "<明文指纹>:<bcrypt 哈希>"：优先读运维配置的 ADMIN_PASS_HASH_CACHED，其次读共享缓存文件"""
+    entries = [os.getenv("ADMIN_PASS_HASH_CACHED", "")]
+    try:
+        with open(ADMIN_PASS_HASH_FILE) as f:
+            entries.append(f.read().strip())
+    except OSError:
+        pass
+    return entries
+
+def _load_admin_hash() -> str:
+    """计算管理员密码的 bcrypt 哈希；明文没变时直接复用缓存，跳过 bcrypt"""
+    _warm_bcrypt()
+    fingerprint = _admin_pass_fingerprint()
+    for entry in _read_cached_admin_hash():
+        cached_fp, _, cached_hash = entry.partition(":")
+        if cached_hash and hmac.compare_digest(cached_fp, fingerprint):
+            return cached_hash
+    pw_hash = pwd_context.hash(ADMIN_PASS_RAW)
+    # 写到共享文件（先写临时文件再替换），reload 和其他 worker 进程启动时可以直接复用
+    try:
+        tmp = f"{ADMIN_PASS_HASH_FILE}.{os.getpid()}.tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            f.write(f"{fingerprint}:{pw_hash}")
+        os.replace(tmp, ADMIN_PASS_HASH_FILE)
+    except OSError:
+        pass
+    return pw_hash
+
+# --- 启动 / 关闭 ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """初始化放在这里而不是 import 时：连接池、建表和 bcrypt 哈希并发进行"""
+    if DATABASE_URL and asyncpg:
+        app.state.pg_pool = await asyncpg.create_pool(DATABASE_URL, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX, command_timeout=30)
+    else:
+        app.state.pg_pool = None
+        await anyio.to_thread.run_sync(_fill_sqlite_pool)
+    app.state.bcrypt_pool = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+    app.state.bcrypt_sem = asyncio.Semaphore(BCRYPT_WORKERS)
+    app.state.sqlite_read_limiter = anyio.CapacityLimiter(SQLITE_MAX_READERS)
+    app.state.sqlite_write_sem = anyio.Semaphore(1)
+    loop = asyncio.get_running_loop()
+    app.state.admin_pass_hash, _ = await asyncio.gather(
+        loop.run_in_executor(app.state.bcrypt_pool, _load_admin_hash),
+        init_db(),
+    )
+    app.state.bookings_lock = asyncio.Lock()
+    app.state.bookings_full = asyncio.Event()
+    app.state.bookings_closed = asyncio.Event()
+    app.state.booking_task = asyncio.create_task(_booking_flusher())
+    await _warm_doctors_cache()
+
+    yield
+
+    # 先把缓冲区里的预约写完再关连接池
+    app.state.bookings_closed.set()
+    app.state.bookings_full.set()
+    await app.state.booking_task
+    if app.state.pg_pool:
+        await app.state.pg_pool.close()
+    app.state.bcrypt_pool.shutdown(wait=False)
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -42,62 +139,244 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- SQL 语句 ---
+# 模块加载时定义一次，各接口直接引用（asyncpg 按 SQL 文本缓存 prepared statement）
+# 统一写成 SQLite 的 ? 占位符，走 PG 时由 _to_pg 改写成 $1, $2 ...
+# 列表只需要卡片上显示的两行简介，完整 description 由详情接口返回
+DOCTOR_BASE_COLS = "id, name, hospital, city, specialty, languages, price, image_url"
+DOCTOR_LIST_COLS = DOCTOR_BASE_COLS + ", substr(description, 1, 200) AS description"
+DOCTOR_DETAIL_COLS = DOCTOR_BASE_COLS + ", description"
+
+SQL_LIST_DOCTORS = f"SELECT {DOCTOR_LIST_COLS} FROM doctors"
+SQL_LIST_DOCTORS_BY_CITY = SQL_LIST_DOCTORS + " WHERE city = ?"
+SQL_GET_DOCTOR = f"SELECT {DOCTOR_DETAIL_COLS} FROM doctors WHERE id = ?"
+SQL_INSERT_DOCTOR = 'INSERT INTO doctors (name, hospital, city, specialty, languages, price, description, image_url) VALUES (?,?,?,?,?,?,?,?) RETURNING id'
+SQL_UPDATE_DOCTOR = 'UPDATE doctors SET name=?, hospital=?, city=?, specialty=?, languages=?, price=?, description=?, image_url=? WHERE id=?'
+SQL_DELETE_DOCTOR = 'DELETE FROM doctors WHERE id=?'
+SQL_INSERT_BOOKING = 'INSERT INTO appointments (doctor_id, patient_name, contact, date, symptoms, payment_id) VALUES (?,?,?,?,?,?) RETURNING id'
+# PG 专用：整批预约按列展开成数组，一条语句插入并返回全部新 id（只需一次往返）
+# 多行 INSERT 的 RETURNING 不保证顺序，所以先用 nextval 给每行分配 id，连同 WITH ORDINALITY 的序号一起返回
+SQL_INSERT_BOOKINGS_PG = (
+    "WITH input AS MATERIALIZED ("
+    "SELECT nextval(pg_get_serial_sequence('appointments', 'id')) AS id, u.* "
+    "FROM unnest($1::int[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[]) "
+    "WITH ORDINALITY AS u(doctor_id, patient_name, contact, date, symptoms, payment_id, ord)), "
+    "ins AS (INSERT INTO appointments (id, doctor_id, patient_name, contact, date, symptoms, payment_id) "
+    "SELECT id, doctor_id, patient_name, contact, date, symptoms, payment_id FROM input) "
+    "SELECT id, ord FROM input"
+)
+# 注意：LEFT JOIN 语法两个数据库是通用的
+SQL_LIST_ORDERS = "SELECT a.id, a.doctor_id, a.patient_name, a.contact, a.date, a.symptoms, a.status, a.payment_id, a.created_at, d.name as doctor_name FROM appointments a LEFT JOIN doctors d ON a.doctor_id = d.id ORDER BY a.id DESC"
+
+@lru_cache(maxsize=128)
+def _to_pg(sql: str) -> str:
+    """? 占位符改写成 $1, $2 ...（注意：SQL 的字符串字面量里不能出现 ?）"""
+    parts = sql.split("?")
+    return "".join(f"{part}${i}" if i < len(parts) else part for i, part in enumerate(parts, 1))
+
 # --- 数据库连接助手 ---
-def get_db_connection():
-    """自动判断使用 PostgreSQL 还是 SQLite"""
-    if DATABASE_URL and psycopg2:
-        # 使用 PostgreSQL
-        conn = psycopg2.connect(DATABASE_URL)
-        return conn, "pg"
-    else:
-        # 使用 SQLite
-        conn = sqlite3.connect("medical.db")
-        conn.row_factory = sqlite3.Row
-        return conn, "sqlite"
-
-def execute_query(query_pg: str, query_sqlite: str, args=()):
-    """执行 SQL，兼容两种数据库语法"""
-    conn, db_type = get_db_connection()
+# page_size 只对新建的数据库文件生效（必须在切换 WAL 之前），对已有文件是空操作
+SQLITE_PRAGMAS = """
+PRAGMA page_size=32768;
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA busy_timeout=5000;
+PRAGMA cache_size=-20000;
+PRAGMA mmap_size=134217728;
+PRAGMA temp_store=MEMORY;
+"""
+
+def _open_sqlite():
+    """打开 SQLite 连接并应用 WAL 等调优参数（PRAGMA 按连接生效）"""
+    conn = sqlite3.connect(DB_NAME, isolation_level=None, check_same_thread=False)
+    conn.executescript(SQLITE_PRAGMAS)
+    return conn
+
+# SQLite 连接池：启动时预先打开，避免每个请求重复 open + PRAGMA
+# WAL 下读可以并行、写只能串行：最多 8 个读线程 + 1 个写线程
+SQLITE_MAX_READERS = 8
+SQLITE_POOL_SIZE = SQLITE_MAX_READERS + 1
+SQLITE_MAX_WAITING = int(os.getenv("SQLITE_MAX_WAITING", "64"))
+_SQLITE_POOL = queue.Queue()
+
+def _fill_sqlite_pool():
+    for _ in range(SQLITE_POOL_SIZE):
+        _SQLITE_POOL.put(_open_sqlite())
+
+@contextmanager
+def sqlite_conn():
+    c = _SQLITE_POOL.get()
     try:
-        if db_type == "pg":
-            cur = conn.cursor(cursor_factory=RealDictCursor)
-            cur.execute(query_pg, args)
-            # 如果是查询语句 (SELECT)
-            if query_pg.strip().upper().startswith("SELECT"):
-                res = cur.fetchall()
-                # 把 RealDictRow 转成普通 dict
-                return [dict(row) for row in res]
-            conn.commit()
-            return {"msg": "ok"}
-        else:
-            cur = conn.cursor()
-            cur.execute(query_sqlite, args)
-            if query_sqlite.strip().upper().startswith("SELECT"):
-                res = cur.fetchall()
-                return [dict(row) for row in res]
-            conn.commit()
-            return {"msg": "ok"}
+        yield c
     finally:
-        conn.close()
+        _SQLITE_POOL.put(c)
+
+def _fetch_sqlite(query: str, args=()):
+    with sqlite_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(query, args)
+        # 不用 sqlite3.Row：普通 tuple + 列名 zip 转 dict 更快
+        cols = [c[0] for c in cur.description]
+        return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+def _execute_sqlite(query: str, args=()):
+    with sqlite_conn() as conn:
+        conn.execute(query, args)
+
+def _insert_sqlite(query: str, args=()):
+    with sqlite_conn() as conn:
+        # 用 fetchall 把语句执行完，autocommit 下才会真正提交
+        return conn.execute(query, args).fetchall()[0][0]
+
+def _check_sqlite_backlog(waiting: int):
+    if waiting >= SQLITE_MAX_WAITING:
+        raise HTTPException(503, "Server busy, please retry", headers={"Retry-After": "1"})
+
+# sqlite3 是阻塞调用，放到线程里执行，避免卡住事件循环
+async def _sqlite_read(func, *args):
+    limiter = app.state.sqlite_read_limiter
+    _check_sqlite_backlog(limiter.statistics().tasks_waiting)
+    return await anyio.to_thread.run_sync(func, *args, limiter=limiter)
+
+async def _sqlite_write(func, *args):
+    # 写操作串行执行，避免多个线程同时卡在 SQLite 写锁上占满线程池
+    sem = app.state.sqlite_write_sem
+    _check_sqlite_backlog(sem.statistics().tasks_waiting)
+    async with sem:
+        return await anyio.to_thread.run_sync(func, *args)
+
+def _insert_many_sqlite(query: str, rows):
+    with sqlite_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN")
+        try:
+            ids = [cur.execute(query, row).fetchall()[0][0] for row in rows]
+            cur.execute("COMMIT")
+        except BaseException:
+            # COMMIT 失败（磁盘满、I/O 错误）也要回滚，不能把开着事务的连接还回连接池
+            if conn.in_transaction: conn.rollback()
+            raise
+        return ids
+
+# INSERT 语句都带 RETURNING id，插入和取新 id 合成一次往返
+async def insert(query: str, args=()) -> int:
+    """执行一条 INSERT ... RETURNING id，返回新 id"""
+    pool = app.state.pg_pool
+    if pool:
+        async with pool.acquire() as conn:
+            return await conn.fetchval(_to_pg(query), *args)
+    return await _sqlite_write(_insert_sqlite, query, args)
+
+async def insert_many(query: str, pg_unnest_query: str, rows) -> List[int]:
+    """批量插入，整批在一个事务里提交，按顺序返回新 id
+
+    PG 走 pg_unnest_query：每列一个数组参数，一条语句、一次往返，按返回的 ord（从 1 开始）对应回输入行；
+    SQLite 在进程内，逐行 RETURNING 即可
+    """
+    pool = app.state.pg_pool
+    if pool:
+        async with pool.acquire() as conn:
+            res = await conn.fetch(pg_unnest_query, *[list(col) for col in zip(*rows)])
+        ids = [None] * len(rows)
+        for row in res:
+            ids[row["ord"] - 1] = row["id"]
+        return ids
+    return await _sqlite_write(_insert_many_sqlite, query, rows)
+
+async def fetch(query: str, args=()):
+    """执行查询语句，返回 dict 列表"""
+    pool = app.state.pg_pool
+    if pool:
+        async with pool.acquire() as conn:
+            res = await conn.fetch(_to_pg(query), *args)
+            # 把 asyncpg Record 转成普通 dict
+            return [dict(row) for row in res]
+    return await _sqlite_read(_fetch_sqlite, query, args)
+
+async def execute(query: str, args=()):
+    """执行写入语句 (INSERT / UPDATE / DELETE)"""
+    pool = app.state.pg_pool
+    if pool:
+        async with pool.acquire() as conn:
+            await conn.execute(_to_pg(query), *args)
+        return
+    await _sqlite_write(_execute_sqlite, query, args)
 
 # --- 数据库初始化 ---
-def init_db():
-    conn, db_type = get_db_connection()
-    cur = conn.cursor()
-    
-    if db_type == "pg":
-        # PostgreSQL 建表 (SERIAL 自增)
-        cur.execute('''CREATE TABLE IF NOT EXISTS doctors (id SERIAL PRIMARY KEY, name TEXT, hospital TEXT, city TEXT, specialty TEXT, languages TEXT, price INTEGER, description TEXT, image_url TEXT)''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS appointments (id SERIAL PRIMARY KEY, doctor_id INTEGER, patient_name TEXT, contact TEXT, date TEXT, symptoms TEXT, status TEXT DEFAULT 'Pending', payment_id TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+# 索引的 SQL 两个数据库通用
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_doctors_city ON doctors(city)",
+    "CREATE INDEX IF NOT EXISTS idx_appt_doctor ON appointments(doctor_id)",
+]
+SCHEMA_PG = [
+    # PostgreSQL 建表 (SERIAL 自增)
+    '''CREATE TABLE IF NOT EXISTS doctors (id SERIAL PRIMARY KEY, name TEXT, hospital TEXT, city TEXT, specialty TEXT, languages TEXT, price INTEGER, description TEXT, image_url TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS appointments (id SERIAL PRIMARY KEY, doctor_id INTEGER, patient_name TEXT, contact TEXT, date TEXT, symptoms TEXT, status TEXT DEFAULT 'Pending', payment_id TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+]
+SCHEMA_SQLITE = [
+    # SQLite 建表 (AUTOINCREMENT)
+    '''CREATE TABLE IF NOT EXISTS doctors (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, hospital TEXT, city TEXT, specialty TEXT, languages TEXT, price INTEGER, description TEXT, image_url TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS appointments (id INTEGER PRIMARY KEY AUTOINCREMENT, doctor_id INTEGER, patient_name TEXT, contact TEXT, date TEXT, symptoms TEXT, status TEXT DEFAULT 'Pending', payment_id TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+]
+
+def _init_sqlite():
+    with sqlite_conn() as conn:
+        cur = conn.cursor()
+        for sql in SCHEMA_SQLITE + INDEXES:
+            cur.execute(sql)
+
+async def init_db():
+    pool = app.state.pg_pool
+    if pool:
+        async with pool.acquire() as conn:
+            for sql in SCHEMA_PG + INDEXES:
+                await conn.execute(sql)
     else:
-        # SQLite 建表 (AUTOINCREMENT)
-        cur.execute('''CREATE TABLE IF NOT EXISTS doctors (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, hospital TEXT, city TEXT, specialty TEXT, languages TEXT, price INTEGER, description TEXT, image_url TEXT)''')
-        cur.execute('''CREATE TABLE IF NOT EXISTS appointments (id INTEGER PRIMARY KEY AUTOINCREMENT, doctor_id INTEGER, patient_name TEXT, contact TEXT, date TEXT, symptoms TEXT, status TEXT DEFAULT 'Pending', payment_id TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
-    conn.commit()
-    conn.close()
+        await _sqlite_write(_init_sqlite)
+
+# --- 预约写入合并 ---
+# 把短时间内到达的预约攒成一批写入，多条 INSERT 共用一次提交（一次 fsync）
+BOOKING_FLUSH_INTERVAL = 0.02  # 秒
+BOOKING_BATCH_MAX = 100
+_pending_bookings: List[tuple] = []  # (row, future)
+
+async def _flush_bookings():
+    async with app.state.bookings_lock:
+        batch = _pending_bookings[:]
+        _pending_bookings.clear()
+    if not batch:
+        return
+    try:
+        ids = await insert_many(SQL_INSERT_BOOKING, SQL_INSERT_BOOKINGS_PG, [row for row, _ in batch])
+    except Exception:
+        # 整批失败时逐条重试，一条坏数据不会连累同批其他人的预约
+        await _insert_bookings_one_by_one(batch)
+        return
+    _invalidate_orders_cache()
+    for (_, fut), new_id in zip(batch, ids):
+        if not fut.done(): fut.set_result(new_id)
 
-init_db()
+async def _insert_bookings_one_by_one(batch):
+    for row, fut in batch:
+        try:
+            new_id = await insert(SQL_INSERT_BOOKING, row)
+        except Exception as e:
+            if not fut.done(): fut.set_exception(e)
+        else:
+            if not fut.done(): fut.set_result(new_id)
+    _invalidate_orders_cache()
+
+async def _booking_flusher():
+    """后台任务：每 20ms 或攒满一批时落库，应用关闭时写完剩余数据后退出"""
+    while True:
+        try:
+            await asyncio.wait_for(app.state.bookings_full.wait(), BOOKING_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        app.state.bookings_full.clear()
+        await _flush_bookings()
+        if app.state.bookings_closed.is_set():
+            return
 
 # --- 模型 ---
 class LoginModel(BaseModel):
@@ -115,7 +394,7 @@ class DoctorModel(BaseModel):
     image_url: Optional[str] = ""
 
 class BookingModel(BaseModel):
-    doctor_id: int
+    doctor_id: int = Field(..., ge=1, le=2**31 - 1)  # 和 INTEGER 列的范围一致
     patient_name: str
     contact: str
     date: str
@@ -123,72 +402,159 @@ class BookingModel(BaseModel):
     payment_id: Optional[str] = ""
 
 # --- 验证 ---
+TOKEN_TTL = 3600  # 登录签发的 token 有效期（秒）
+
+def _sign(payload: str) -> str:
+    return hmac.new(SECRET_TOKEN.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+def _issue_token() -> str:
+    """签发短期 token：过期时间.随机数.HMAC-SHA256 签名"""
+    payload = f"{int(time.time()) + TOKEN_TTL}.{secrets.token_hex(8)}"
+    return f"{payload}.{_sign(payload)}"
+
+def _check_token(token: str) -> bool:
+    # 兼容直接使用 SECRET_TOKEN 的调用方；比较一律用 compare_digest 防止计时攻击
+    if hmac.compare_digest(token.encode(), SECRET_TOKEN.encode()):
+        return True
+    payload, _, sig = token.rpartition(".")
+    if not hmac.compare_digest(sig.encode(), _sign(payload).encode()):
+        return False
+    expiry = payload.split(".")[0]
+    return expiry.isascii() and expiry.isdigit() and int(expiry) > time.time()
+
 def verify_admin(authorization: str = Header(None)):
-    if not authorization: raise HTTPException(401)
-    try:
-        scheme, token = authorization.split()
-        if scheme.lower() != 'bearer' or token != SECRET_TOKEN: raise HTTPException(401)
-    except: raise HTTPException(401)
+    if not authorization or not authorization.startswith("Bearer "): raise HTTPException(401)
+    if not _check_token(authorization[7:]): raise HTTPException(401)
 
 # --- API ---
+async def verify_password(password: str) -> bool:
+    """在 bcrypt 线程池中校验密码；排队过长时直接返回 503"""
+    sem = app.state.bcrypt_sem
+    if sem.locked() and metrics["bcrypt_queue_length"] >= BCRYPT_MAX_QUEUE:
+        raise HTTPException(503, "Server busy, please retry", headers={"Retry-After": "1"})
+    metrics["bcrypt_queue_length"] += 1
+    try:
+        await sem.acquire()
+    finally:
+        metrics["bcrypt_queue_length"] -= 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(app.state.bcrypt_pool, pwd_context.verify, password, app.state.admin_pass_hash)
+    finally:
+        sem.release()
+
 @app.post("/api/login")
-def login(creds: LoginModel):
-    if creds.username == "admin" and pwd_context.verify(creds.password, ADMIN_PASS_HASH):
-        return {"token": SECRET_TOKEN}
+async def login(creds: LoginModel):
+    if creds.username == "admin" and await verify_password(creds.password):
+        return {"token": _issue_token()}
     raise HTTPException(401, "Invalid credentials")
 
+# /api/doctors 响应缓存：city -> (orjson 编码后的 body, ETag)，启动时预热，管理员改动医生数据时清空
+DOCTORS_CACHE_CONTROL = "public, max-age=60"
+_doctors_cache: Dict[str, tuple] = {}
+_doctors_cache_gen = 0
+
+def _invalidate_doctors_cache():
+    global _doctors_cache_gen
+    _doctors_cache_gen += 1
+    _doctors_cache.clear()
+
+async def _load_doctors(city: str) -> tuple:
+    cached = _doctors_cache.get(city)
+    if cached is None:
+        gen = _doctors_cache_gen
+        if city != "All":
+            rows = await fetch(SQL_LIST_DOCTORS_BY_CITY, (city,))
+        else:
+            rows = await fetch(SQL_LIST_DOCTORS)
+        body = orjson.dumps(rows)
+        cached = (body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"')
+        # 查询期间数据被改过就不写缓存，避免存进旧数据
+        if gen == _doctors_cache_gen:
+            _doctors_cache[city] = cached
+    return cached
+
+async def _warm_doctors_cache():
+    for city in ALLOWED_CITIES:
+        await _load_doctors(city)
+
 @app.get("/api/doctors")
-def get_doctors(city: Optional[str] = "All"):
-    # PG 使用 %s, SQLite 使用 ?
-    query_base = "SELECT * FROM doctors"
-    if city and city != "All":
-        return execute_query(query_base + " WHERE city = %s", query_base + " WHERE city = ?", (city,))
-    else:
-        return execute_query(query_base, query_base)
+async def get_doctors(city: Optional[str] = "All", if_none_match: Optional[str] = Header(None)):
+    city = city or "All"
+    if city not in ALLOWED_CITIES: raise HTTPException(400, "Unsupported city")
+    body, etag = await _load_doctors(city)
+    headers = {"ETag": etag, "Cache-Control": DOCTORS_CACHE_CONTROL}
+    if if_none_match and etag in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/api/doctors/{id}")
+async def get_doctor(id: int):
+    res = await fetch(SQL_GET_DOCTOR, (id,))
+    if not res: raise HTTPException(404, "Doctor not found")
+    return ORJSONResponse(res[0])
 
 @app.post("/api/book")
-def book(booking: BookingModel):
-    # PG 使用 %s, SQLite 使用 ?
-    sql_pg = 'INSERT INTO appointments (doctor_id, patient_name, contact, date, symptoms, payment_id) VALUES (%s,%s,%s,%s,%s,%s)'
-    sql_lite = 'INSERT INTO appointments (doctor_id, patient_name, contact, date, symptoms, payment_id) VALUES (?,?,?,?,?,?)'
-    
-    execute_query(sql_pg, sql_lite, 
-                  (booking.doctor_id, booking.patient_name, booking.contact, booking.date, booking.symptoms, booking.payment_id))
-    return {"message": "received"}
+async def book(booking: BookingModel):
+    # 放进合并缓冲区，等所在批次提交后再返回（保证返回时订单已落库）
+    fut = asyncio.get_running_loop().create_future()
+    async with app.state.bookings_lock:
+        _pending_bookings.append(((booking.doctor_id, booking.patient_name, booking.contact, booking.date, booking.symptoms, booking.payment_id), fut))
+        if len(_pending_bookings) >= BOOKING_BATCH_MAX:
+            app.state.bookings_full.set()
+    return {"message": "received", "id": await fut}
 
 # 管理员接口
+def _check_city(city: str):
+    if city == "All" or city not in ALLOWED_CITIES: raise HTTPException(400, "Unsupported city")
+
 @app.post("/api/admin/doctors", dependencies=[Depends(verify_admin)])
-def add_doc(doc: DoctorModel):
+async def add_doc(doc: DoctorModel):
+    _check_city(doc.city)
     if not doc.image_url: doc.image_url = f"https://source.unsplash.com/random/400x300/?doctor,{doc.specialty}"
-    
-    sql_pg = 'INSERT INTO doctors (name, hospital, city, specialty, languages, price, description, image_url) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)'
-    sql_lite = 'INSERT INTO doctors (name, hospital, city, specialty, languages, price, description, image_url) VALUES (?,?,?,?,?,?,?,?)'
-    
-    execute_query(sql_pg, sql_lite, 
-                  (doc.name, doc.hospital, doc.city, doc.specialty, doc.languages, doc.price, doc.description, doc.image_url))
-    return {"msg": "ok"}
+    new_id = await insert(SQL_INSERT_DOCTOR,
+                          (doc.name, doc.hospital, doc.city, doc.specialty, doc.languages, doc.price, doc.description, doc.image_url))
+    _invalidate_doctors_cache()
+    _invalidate_orders_cache()
+    return {"msg": "ok", "id": new_id}
 
 @app.put("/api/admin/doctors/{id}", dependencies=[Depends(verify_admin)])
-def update_doc(id: int, doc: DoctorModel):
-    sql_pg = 'UPDATE doctors SET name=%s, hospital=%s, city=%s, specialty=%s, languages=%s, price=%s, description=%s, image_url=%s WHERE id=%s'
-    sql_lite = 'UPDATE doctors SET name=?, hospital=?, city=?, specialty=?, languages=?, price=?, description=?, image_url=? WHERE id=?'
-    
-    execute_query(sql_pg, sql_lite, 
+async def update_doc(id: int, doc: DoctorModel):
+    _check_city(doc.city)
+    await execute(SQL_UPDATE_DOCTOR,
                   (doc.name, doc.hospital, doc.city, doc.specialty, doc.languages, doc.price, doc.description, doc.image_url, id))
+    _invalidate_doctors_cache()
+    _invalidate_orders_cache()
     return {"msg": "updated"}
 
 @app.delete("/api/admin/doctors/{id}", dependencies=[Depends(verify_admin)])
-def delete_doc(id: int):
-    sql_pg = 'DELETE FROM doctors WHERE id=%s'
-    sql_lite = 'DELETE FROM doctors WHERE id=?'
-    execute_query(sql_pg, sql_lite, (id,))
+async def delete_doc(id: int):
+    await execute(SQL_DELETE_DOCTOR, (id,))
+    _invalidate_doctors_cache()
+    _invalidate_orders_cache()
     return {"msg": "deleted"}
 
+# 订单列表被后台页面频繁轮询：缓存编码后的 body 2 秒，有新预约或医生变动时立即失效
+ORDERS_CACHE_TTL = 2.0
+_orders_cache = {"t": 0.0, "body": b"", "gen": 0}
+
+def _invalidate_orders_cache():
+    _orders_cache["t"] = 0.0
+    _orders_cache["gen"] += 1
+
 @app.get("/api/admin/orders", dependencies=[Depends(verify_admin)])
-def get_orders():
-    # 注意：LEFT JOIN 语法两个数据库是通用的
-    sql = "SELECT a.*, d.name as doctor_name FROM appointments a LEFT JOIN doctors d ON a.doctor_id = d.id ORDER BY a.id DESC"
-    return execute_query(sql, sql)
+async def get_orders():
+    if time.monotonic() - _orders_cache["t"] < ORDERS_CACHE_TTL:
+        return Response(_orders_cache["body"], media_type="application/json")
+    gen = _orders_cache["gen"]
+    body = orjson.dumps(await fetch(SQL_LIST_ORDERS))
+    if gen == _orders_cache["gen"]:
+        _orders_cache.update(t=time.monotonic(), body=body)
+    return Response(body, media_type="application/json")
+
+@app.get("/api/admin/metrics", dependencies=[Depends(verify_admin)])
+def get_metrics():
+    return metrics
 
 if __name__ == "__main__":
     import uvicorn